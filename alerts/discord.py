@@ -2,30 +2,85 @@
 """
 Discord webhook alerter. Reads deals.json and sends rich embeds.
 """
-import json
+import orjson
 import argparse
+import asyncio
 import os
-from discord_webhook import DiscordWebhook, DiscordEmbed
+from datetime import datetime, timezone
+import aiohttp
 
-def send_alert(webhook_url: str, deal: dict):
-    if not webhook_url:
-        return False
+# Discord accepts at most 10 embeds per webhook message
+MAX_EMBEDS_PER_MESSAGE = 10
+
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def build_embed(deal: dict):
+    return {
+        "title": f"{deal['flag']} {deal['title'][:100]}",
+        "description": f"**Price:** S${deal['price_sgd']} | **Z-Score:** {deal['z_score']}",
+        "color": 0xFF5733 if 'GREAT' in deal['flag'] else 0x33FF57,
+        "fields": [
+            {"name": "Source", "value": deal.get('source', 'Unknown').title(), "inline": True},
+            {"name": "Link", "value": f"[View Listing]({deal['url']})", "inline": True},
+        ],
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+async def _wait_for_rate_limit(headers, gate: asyncio.Lock):
+    """
+    Holds the shared gate until Discord's bucket resets when it reports no
+    requests left, so other batches pause instead of collecting 429s.
+    """
+    if headers.get('X-RateLimit-Remaining') == '0':
+        async with gate:
+            await asyncio.sleep(float(headers.get('X-RateLimit-Reset-After', 1)))
+
+async def send_batch(session: aiohttp.ClientSession, webhook_url: str, deals: list, gate: asyncio.Lock):
+    payload = {"embeds": [build_embed(deal) for deal in deals]}
+    
+    for attempt in range(MAX_RETRIES + 1):
+        # Wait out a rate-limit pause held by another batch
+        async with gate:
+            pass
         
-    embed = DiscordEmbed(
-        title=f"{deal['flag']} {deal['title'][:100]}",
-        description=f"**Price:** S${deal['price_sgd']} | **Z-Score:** {deal['z_score']}",
-        color='FF5733' if 'GREAT' in deal['flag'] else '33FF57'
-    )
+        backoff = BACKOFF_FACTOR * 2 ** attempt
+        try:
+            async with session.post(webhook_url, json=payload) as response:
+                status, headers = response.status, response.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"  [Discord] Error: {e}")
+            status, headers = None, {}
+        
+        if status in [200, 204]:
+            await _wait_for_rate_limit(headers, gate)
+            return True
+        
+        if (status is not None and status not in RETRY_STATUSES) or attempt == MAX_RETRIES:
+            return False
+        
+        await asyncio.sleep(float(headers.get('Retry-After', backoff)))
+    
+    return False
+
+async def send_alerts(webhook_url: str, deals: list):
+    """
+    Sends deals in batches of up to 10 embeds over one keep-alive session.
+    Returns: One success flag per deal.
+    """
+    if not webhook_url:
+        return [False] * len(deals)
     
-    embed.add_embed_field(name="Source", value=deal.get('source', 'Unknown').title())
-    embed.add_embed_field(name="Link", value=f"[View Listing]({deal['url']})")
-    embed.set_timestamp()
+    batches = [deals[i:i + MAX_EMBEDS_PER_MESSAGE] for i in range(0, len(deals), MAX_EMBEDS_PER_MESSAGE)]
+    gate = asyncio.Lock()
     
-    webhook = DiscordWebhook(url=webhook_url)
-    webhook.add_embed(embed)
-    response = webhook.execute()
+    connector = aiohttp.TCPConnector(limit=10, keepalive_timeout=85)
+    timeout = aiohttp.ClientTimeout(total=5)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(*(send_batch(session, webhook_url, batch, gate) for batch in batches))
     
-    return response.status_code in [200, 204]
+    return [success for batch, success in zip(batches, results) for _ in batch]
 
 def main():
     parser = argparse.ArgumentParser()
@@ -42,15 +97,15 @@ def main():
         print("ℹ️ No deals file found")
         return
 
-    with open(args.input) as f:
-        deals = json.load(f)
+    with open(args.input, 'rb') as f:
+        deals = orjson.loads(f.read())
     
     if not deals:
         print("ℹ️ No deals to alert")
         return
     
-    for deal in deals:
-        success = send_alert(webhook_url, deal)
+    results = asyncio.run(send_alerts(webhook_url, deals))
+    for deal, success in zip(deals, results):
         print(f"{'✅' if success else '❌'} Alerted: {deal['title'][:50]}...")
 
 if __name__ == "__main__":
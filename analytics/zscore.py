@@ -2,65 +2,404 @@
 """
 Pricing anomaly detector using Z-score on Git history.
 Reads all JSON files in data/, calculates statistics, flags deals.
+Scores are robust z-scores against the per-source median and MAD.
 """
-import json
+import orjson
 import argparse
+import pickle
+import time
 from pathlib import Path
-from datetime import datetime, timedelta
-import statistics
+from datetime import datetime, timedelta, timezone
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-def load_historical_data(data_dir: str, lookback_days: int):
+LOAD_WORKERS = 32
+
+# Z-scores only need a representative sample; keep the most recent prices
+MAX_HISTORY_PER_SOURCE = 5000
+
+def iter_snapshot(json_file: str):
     """
-    Loads all JSON snapshots from data_dir within lookback window.
-    Returns: List of all items with prices.
+    Streams items from an NDJSON snapshot (one listing per line).
+    Legacy snapshots holding a single JSON array are still accepted.
     """
-    cutoff = datetime.utcnow() - timedelta(days=lookback_days)
-    all_items = []
+    with open(json_file, 'rb') as f:
+        first = f.readline()
+        if first.lstrip().startswith(b'['):
+            yield from orjson.loads(first + f.read())
+            return
+        
+        for line in chain((first,), f):
+            if line.strip():
+                yield orjson.loads(line)
+
+def _load_one(json_file: str):
+    """
+    Reads a single snapshot, keeping only the positive prices per source.
+    Returns {} for unreadable or malformed files.
+    """
+    prices = defaultdict(lambda: array('f'))
+    try:
+        for item in iter_snapshot(json_file):
+            if item.get('price_sgd', 0) > 0:
+                prices[item.get('source')].append(item['price_sgd'])
+    except Exception:
+        return {}
     
-    # Walk through all tool subdirectories
-    for json_file in Path(data_dir).rglob('*.json'):
-        try:
-            # Filename format: YYYY-MM-DD_HH-MM.json
-            ts_str = json_file.stem
-            file_time = datetime.strptime(ts_str, '%Y-%m-%d_%H-%M')
-            
-            if file_time < cutoff:
+    return prices
+
+def _parse_snapshot_time(stem: str):
+    """
+    Parses a YYYY-MM-DD_HH-MM snapshot stem by slicing, which is much
+    cheaper than strptime when most of data/ falls outside the window.
+    Returns None for names that don't match.
+    """
+    if len(stem) != 16 or stem[4] != '-' or stem[7] != '-' or stem[10] != '_' or stem[13] != '-':
+        return None
+    try:
+        return datetime(int(stem[0:4]), int(stem[5:7]), int(stem[8:10]), int(stem[11:13]), int(stem[14:16]))
+    except ValueError:
+        return None
+
+def _snapshot_files(data_dir: str, cutoff: datetime, min_mtime: float = 0.0):
+    """
+    Yields (path, file_time, mtime) for snapshots inside the window whose
+    mtime is newer than min_mtime, filtering before any file is opened.
+    """
+    cutoff_ts = cutoff.replace(tzinfo=timezone.utc).timestamp()
+    min_mtime = max(min_mtime, cutoff_ts)
+    
+    if not os.path.isdir(data_dir):
+        return
+    
+    # Snapshots live exactly at data/{source}/*.json, so walk two levels
+    # with scandir rather than recursing and building a Path per entry
+    with os.scandir(data_dir) as source_dirs:
+        for source_dir in source_dirs:
+            if not source_dir.is_dir():
                 continue
             
-            with open(json_file) as f:
-                items = json.load(f)
-                all_items.extend(items)
+            with os.scandir(source_dir.path) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.json'):
+                        continue
+                    
+                    # A snapshot last written before the cutoff cannot be inside the window
+                    mtime = entry.stat().st_mtime
+                    if mtime < min_mtime:
+                        continue
+                    
+                    # Filename format: YYYY-MM-DD_HH-MM.json
+                    file_time = _parse_snapshot_time(entry.name[:-5])
+                    
+                    # Skip files that don't match pattern
+                    if file_time is not None and file_time >= cutoff:
+                        yield entry.path, file_time, mtime
+
+# Hive-style partitions of the Parquet rollup, read back as plain strings
+ROLLUP_PARTITIONING = ds.partitioning(pa.schema([('source', pa.string()), ('date', pa.string())]), flavor='hive')
+
+def update_rollup(data_dir: str, rollup_dir: str, cutoff: datetime):
+    """
+    Adds in-window snapshots that aren't rolled up yet to the Parquet rollup,
+    one file per snapshot under rollup_dir/source=<dir>/date=<YYYY-MM-DD>/.
+    Existing snapshots are backfilled on first use. Returns the number added.
+    """
+    added = 0
+    for json_file, file_time, _ in _snapshot_files(data_dir, cutoff):
+        source = os.path.basename(os.path.dirname(json_file))
+        target_dir = os.path.join(rollup_dir, f"source={source}", f"date={file_time.date().isoformat()}")
+        target = os.path.join(target_dir, os.path.basename(json_file)[:-5] + '.parquet')
+        if os.path.exists(target):
+            continue
+        
+        try:
+            prices = [item['price_sgd'] for item in iter_snapshot(json_file) if item.get('price_sgd', 0) > 0]
         except Exception:
-            # Skip files that don't match pattern
             continue
+        
+        # Write under a dot-prefixed temp name (ignored by dataset discovery) and
+        # rename into place, so an interrupted write is redone on the next run
+        os.makedirs(target_dir, exist_ok=True)
+        tmp = os.path.join(target_dir, f".{os.path.basename(target)}.tmp{os.getpid()}")
+        pq.write_table(pa.table({
+            'price_sgd': pa.array(prices, type=pa.float32()),
+            'timestamp': pa.array([file_time] * len(prices), type=pa.timestamp('s')),
+        }), tmp)
+        os.replace(tmp, target)
+        added += 1
     
-    return all_items
+    return added
 
-def calculate_zscore(items: list, current_price: float):
-    if len(items) < 3:
-        return 0.0
+def load_rollup(rollup_dir: str, cutoff: datetime):
+    """
+    Reads in-window prices from the Parquet rollup in one columnar scan,
+    pruning whole date partitions before the cutoff. Sources are the
+    snapshot directory names.
+    Returns: {source: float32 np.ndarray of positive prices}
+    """
+    dataset = ds.dataset(rollup_dir, format='parquet', partitioning=ROLLUP_PARTITIONING)
     
-    prices = [item['price_sgd'] for item in items if 'price_sgd' in item and item['price_sgd'] > 0]
+    # A rollup directory with no files yet has no schema to filter on
+    if not dataset.files:
+        return {}
     
-    if not prices:
-        return 0.0
+    table = dataset.to_table(
+        columns=['source', 'price_sgd', 'timestamp'],
+        filter=(ds.field('date') >= cutoff.date().isoformat()) & (ds.field('timestamp') >= pa.scalar(cutoff, type=pa.timestamp('s'))),
+    )
     
-    mu = statistics.mean(prices)
-    sigma = statistics.stdev(prices) if len(prices) > 1 else 1.0
+    # Keep the most recent prices per source, matching the snapshot loader's cap
+    df = table.to_pandas().sort_values('timestamp', kind='stable')
+    df = df.groupby('source').tail(MAX_HISTORY_PER_SOURCE)
     
-    if sigma == 0:
-        return 0.0
+    return {source: prices.to_numpy(dtype=np.float32) for source, prices in df.groupby('source')['price_sgd']}
+
+def load_historical_data(data_dir: str, lookback_days: int, rollup_dir: str = None):
+    """
+    Loads all snapshots from data_dir within lookback window, keeping at
+    most the MAX_HISTORY_PER_SOURCE most recent prices per source.
+    With rollup_dir, history is read from the Parquet rollup (kept current
+    by update_rollup) instead of parsing every JSON file.
+    Returns: {source: float32 np.ndarray of positive prices}
+    """
+    cutoff = datetime.utcnow() - timedelta(days=lookback_days)
+    
+    if rollup_dir:
+        if not os.path.isdir(rollup_dir):
+            return {}
+        return load_rollup(rollup_dir, cutoff)
+    
+    # Oldest first, so the bounded deques end up holding the latest prices
+    paths = [path for path, _, _ in sorted(_snapshot_files(data_dir, cutoff), key=lambda f: f[1])]
+    
+    # Reads are I/O-bound and release the GIL, so overlap them
+    source_prices = defaultdict(lambda: deque(maxlen=MAX_HISTORY_PER_SOURCE))
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+        for file_prices in pool.map(_load_one, paths):
+            for source, prices in file_prices.items():
+                source_prices[source].extend(prices)
+    
+    return {
+        source: np.fromiter(prices, dtype=np.float32, count=len(prices))
+        for source, prices in source_prices.items()
+    }
+
+# Consistency constants making MAD / mean absolute deviation comparable to
+# a normal distribution's sigma
+MAD_SCALE = 1.4826
+MEAN_AD_SCALE = 1.2533
+
+def _weighted_median(values: np.ndarray, counts: np.ndarray):
+    """
+    Median of sorted values each repeated counts times; matches np.median
+    on the expanded array, averaging the two middle ranks for even totals.
+    """
+    cum = np.cumsum(counts)
+    n = cum[-1]
+    lo = values[np.searchsorted(cum, (n - 1) // 2, side='right')]
+    hi = values[np.searchsorted(cum, n // 2, side='right')]
+    return (lo + hi) / 2
+
+def robust_stats(values: np.ndarray, counts: np.ndarray):
+    """
+    Returns the robust (median, 1.4826 * MAD) location/scale of a price
+    distribution given as sorted distinct values and their counts.
+    When more than half the prices are identical MAD is 0, so the scale
+    falls back to the (normal-consistent) mean absolute deviation.
+    Returns None when the history is too thin or entirely flat.
+    """
+    if counts.sum() < 3:
+        return None
+    
+    center = _weighted_median(values, counts)
+    deviations = np.abs(values - center)
+    
+    order = np.argsort(deviations, kind='stable')
+    scale = MAD_SCALE * _weighted_median(deviations[order], counts[order])
+    if scale == 0:
+        scale = MEAN_AD_SCALE * np.average(deviations, weights=counts)
+    
+    if scale == 0:
+        return None
         
-    return (current_price - mu) / sigma
+    return float(center), float(scale)
+
+def price_stats(prices: np.ndarray):
+    """
+    Returns the robust (median, scale) of a source's price history, or None
+    when the history is too thin or flat to score against.
+    """
+    values, counts = np.unique(prices, return_counts=True)
+    return robust_stats(values.astype(np.float64), counts)
 
-def analyze_deals(data_dir: str, lookback_days: int, z_threshold: float = -1.5):
-    historical = load_historical_data(data_dir, lookback_days)
+def _atomic_write(path: str, data: bytes):
+    """
+    Writes via a temp file and os.replace, so readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+# Bump when the state layout changes so old files are rebuilt
+STATE_VERSION = 3
+
+def _read_state(state_file: str, lookback_days: int):
+    """
+    Loads the running-stats state, or an empty one to rebuild from when the
+    file is missing, unreadable, or was built for a different lookback.
+    """
+    empty = {'version': STATE_VERSION, 'lookback_days': lookback_days, 'last_mtime': 0.0, 'snapshots': {}}
+    try:
+        with open(state_file, 'rb') as f:
+            state = orjson.loads(f.read())
+    except FileNotFoundError:
+        return empty
+    except Exception as e:
+        print(f"⚠️ Unreadable state file {state_file} ({e}), rebuilding")
+        return empty
+    
+    if (not isinstance(state, dict) or state.get('version') != STATE_VERSION
+            or state.get('lookback_days') != lookback_days or not {'last_mtime', 'snapshots'} <= state.keys()):
+        return empty
+    
+    return state
+
+def update_running_stats(data_dir: str, lookback_days: int, state_file: str):
+    """
+    Incremental alternative to load_historical_data + price_stats.
+    Keeps each in-window snapshot's parsed prices in state_file and only
+    reads snapshots written since the last run; snapshots older than the
+    cutoff are dropped. Statistics are price_stats over the same
+    MAX_HISTORY_PER_SOURCE most recent prices a full scan would keep.
+    Changing lookback_days rebuilds the state.
+    Returns: {source: (center, scale)}
+    """
+    cutoff = datetime.utcnow() - timedelta(days=lookback_days)
+    cutoff_ts = cutoff.replace(tzinfo=timezone.utc).timestamp()
+    
+    state = _read_state(state_file, lookback_days)
+    
+    # Roll off snapshots outside the window
+    snapshots = {name: snap for name, snap in state['snapshots'].items() if snap['time'] >= cutoff_ts}
+    last_mtime = state['last_mtime']
+    
+    for json_file, file_time, mtime in _snapshot_files(data_dir, cutoff, min_mtime=state['last_mtime']):
+        name = os.path.relpath(json_file, data_dir)
+        
+        # Guard against refolding a snapshot whose mtime was bumped (e.g. by git)
+        if name not in snapshots:
+            snapshots[name] = {
+                'time': file_time.replace(tzinfo=timezone.utc).timestamp(),
+                'prices': {source: prices.tolist() for source, prices in _load_one(json_file).items()},
+            }
+        last_mtime = max(last_mtime, mtime)
+    
+    _atomic_write(state_file, orjson.dumps({
+        'version': STATE_VERSION, 'lookback_days': lookback_days, 'last_mtime': last_mtime, 'snapshots': snapshots
+    }))
+    
+    # Oldest first, so the bounded deques end up holding the latest prices
+    source_prices = defaultdict(lambda: deque(maxlen=MAX_HISTORY_PER_SOURCE))
+    for name in sorted(snapshots, key=lambda n: (snapshots[n]['time'], n)):
+        for source, prices in snapshots[name]['prices'].items():
+            source_prices[source].extend(prices)
+    
+    source_stats = {}
+    for source, prices in source_prices.items():
+        if (stats := price_stats(np.fromiter(prices, dtype=np.float32, count=len(prices)))) is not None:
+            source_stats[source] = stats
+    
+    return source_stats
+
+def calculate_zscore(current_prices: np.ndarray, center: float, scale: float):
+    return (current_prices - center) / scale
+
+def _data_version(data_dir: str):
+    """
+    Newest mtime among data_dir, its source directories and their *.json
+    snapshots, so both new and rewritten snapshots invalidate cached stats.
+    """
+    if not os.path.isdir(data_dir):
+        return 0.0
+    
+    newest = os.stat(data_dir).st_mtime
+    with os.scandir(data_dir) as source_dirs:
+        for source_dir in source_dirs:
+            if not source_dir.is_dir():
+                continue
+            
+            newest = max(newest, source_dir.stat().st_mtime)
+            with os.scandir(source_dir.path) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json'):
+                        newest = max(newest, entry.stat().st_mtime)
+    
+    return newest
+
+@lru_cache(maxsize=64)
+def _cached_source_stats(data_dir: str, lookback_days: int, data_version: float, hour_bucket: int, cache_file: str, rollup_dir: str = None):
+    """
+    Full-scan per-source statistics, memoized in-process and in cache_file.
+    The hour bucket invalidates entries as the lookback window slides.
+    """
+    key = (data_dir, lookback_days, data_version, hour_bucket, rollup_dir)
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if key in cached:
+                return cached[key]
+        except Exception:
+            pass # Unreadable cache, recompute
+    
+    historical = load_historical_data(data_dir, lookback_days, rollup_dir)
+    source_stats = {
+        source: stats
+        for source, prices in historical.items()
+        if (stats := price_stats(prices)) is not None
+    }
+    
+    if cache_file:
+        _atomic_write(cache_file, pickle.dumps({key: source_stats}))
+    
+    return source_stats
+
+def analyze_deals(data_dir: str, lookback_days: int, z_threshold: float = -1.5, state_file: str = None, cache_file: str = None, rollup_dir: str = None):
+    if state_file and (cache_file or rollup_dir):
+        raise ValueError("state_file is an alternative to cache_file/rollup_dir, not combinable with them")
+    
+    # Global distribution per source; ideally we'd match by title similarity.
+    # Statistics are computed once per source, not per scored item.
+    if state_file:
+        source_stats = update_running_stats(data_dir, lookback_days, state_file)
+    else:
+        # Append new snapshots outside the memoized lookup so the rollup
+        # stays current even when cached statistics are reused
+        if rollup_dir:
+            update_rollup(data_dir, rollup_dir, datetime.utcnow() - timedelta(days=lookback_days))
+        
+        source_stats = _cached_source_stats(
+            os.path.abspath(data_dir), lookback_days, _data_version(data_dir), int(time.time() // 3600), cache_file, rollup_dir
+        )
     
     # Get latest snapshot per source
     sources = ['carousell', 'ebay', 'slickdeals']
     deals = []
     
     for source in sources:
+        if source not in source_stats:
+            continue
+        
         source_dir = Path(data_dir) / source
         if not source_dir.exists():
             continue
@@ -71,28 +410,24 @@ def analyze_deals(data_dir: str, lookback_days: int, z_threshold: float = -1.5):
             
         latest_file = max(json_files, key=lambda p: p.stat().st_mtime)
         try:
-            with open(latest_file) as f:
-                current_items = json.load(f)
+            current_items = list(iter_snapshot(latest_file))
         except:
             continue
-            
-        for item in current_items:
-            if 'price_sgd' not in item or item['price_sgd'] <= 0:
-                continue
-            
-            # Filter historical to same source/item type roughly if possible
-            # For MVP, we use global Z-score for simplicity, or source-specific
-            # Ideally we match by title similarity, but for now global distribution per source
-            
-            # Filter history by source
-            source_history = [h for h in historical if h.get('source') == source]
-            
-            z = calculate_zscore(source_history, item['price_sgd'])
-            
-            if z < z_threshold:
-                item['z_score'] = round(z, 2)
-                item['flag'] = '🔥 GREAT DEAL'
-                deals.append(item)
+        
+        current_items = [i for i in current_items if i.get('price_sgd', 0) > 0]
+        if not current_items:
+            continue
+        
+        current_prices = np.fromiter((i['price_sgd'] for i in current_items), dtype=np.float64, count=len(current_items))
+        center, scale = source_stats[source]
+        
+        z = calculate_zscore(current_prices, center, scale)
+        
+        for idx in np.flatnonzero(z < z_threshold):
+            item = current_items[idx]
+            item['z_score'] = round(float(z[idx]), 2)
+            item['flag'] = '🔥 GREAT DEAL'
+            deals.append(item)
     
     return deals
 
@@ -101,13 +436,23 @@ def main():
     parser.add_argument('--data-dir', required=True)
     parser.add_argument('--lookback-days', type=int, default=30)
     parser.add_argument('--output', required=True)
+    parser.add_argument('--state-file', help='Persist parsed in-window snapshots here and only read new ones')
+    parser.add_argument('--stats-cache', help='Reuse full-scan statistics from this pickle while data/ is unchanged (hourly)')
+    parser.add_argument('--rollup-dir', help='Maintain a partitioned Parquet price rollup here and read history from it')
     args = parser.parse_args()
     
-    deals = analyze_deals(args.data_dir, args.lookback_days)
+    # The incremental state path never scans history, so it can't use either
+    if args.state_file and (args.stats_cache or args.rollup_dir):
+        parser.error("--state-file cannot be combined with --stats-cache or --rollup-dir")
+    
+    deals = analyze_deals(
+        args.data_dir, args.lookback_days,
+        state_file=args.state_file, cache_file=args.stats_cache, rollup_dir=args.rollup_dir
+    )
     
     os.makedirs(os.path.dirname(args.output), exist_ok=True)
-    with open(args.output, 'w') as f:
-        json.dump(deals, f, indent=2)
+    with open(args.output, 'wb') as f:
+        f.write(orjson.dumps(deals, option=orjson.OPT_INDENT_2))
     
     print(f"✅ Found {len(deals)} deals -> {args.output}")
     
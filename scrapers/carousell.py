@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 """
-Carousell X399 scraper using Playwright (primary) and curl-cffi (backup).
-Outputs JSON with normalized schema.
+Carousell X399 scraper using the internal search API via curl-cffi (primary)
+and Playwright (fallback).
+Outputs NDJSON (one listing per line) with normalized schema.
 """
 import asyncio
-import json
+import orjson
 import argparse
 import os
 import sys
@@ -15,7 +16,7 @@ import yaml
 # Import Playwright
 from playwright.async_api import async_playwright
 
-# Import curl_cffi for backup
+# Import curl_cffi for the API scraper
 try:
     from curl_cffi import requests as crequests
     CURL_CFFI_AVAILABLE = True
@@ -44,165 +45,274 @@ def parse_proxy_url(proxy_url):
         "password": parsed.password
     }
 
-async def scrape_playwright(search_query, proxy_config=None, max_results=50):
+# Deletes currency prefix, thousands separators and spaces in one C-level pass
+_PRICE_STRIP = str.maketrans('', '', 'S$, ')
+
+def parse_price(price_text):
+    """
+    Cleans a listing price: "S$1,234" -> 1234.0. Returns 0.0 if unparseable.
+    """
+    try:
+        return float(price_text.translate(_PRICE_STRIP))
+    except ValueError:
+        return 0.0
+
+# Cap parallel queries so a burst of searches doesn't trip the WAF
+MAX_CONCURRENT_QUERIES = 5
+
+# Carousell structure heavily uses data-testid
+EXTRACT_CARDS_JS = """
+(maxResults) => Array.from(document.querySelectorAll('[data-testid="listing-card"]'))
+    .slice(0, maxResults)
+    .map(card => ({
+        title: card.querySelector('p[data-testid="listing-card-text-title"]')?.innerText ?? null,
+        price: card.querySelector('p[data-testid="listing-card-text-price"]')?.innerText ?? null,
+        href: card.querySelector('a')?.getAttribute('href') ?? null,
+        seller: card.querySelector('p[data-testid="listing-card-text-seller-name"]')?.innerText ?? null,
+    }))
+"""
+
+# Only the document, scripts and XHR are needed to render listing cards
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+BLOCKED_DOMAINS = ("googletagmanager", "google-analytics", "doubleclick", "facebook.net", "segment.io", "branch.io")
+
+async def block_heavy_resources(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(d in request.url for d in BLOCKED_DOMAINS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def scrape_playwright(browser, search_query, max_results=50, storage_state=None, captured_states=None):
     """
-    Scrapes Carousell using Playwright.
+    Scrapes Carousell using Playwright, in a fresh context on a shared browser.
+    storage_state (a dict) seeds the context's cookies; after a successful
+    scrape the context's state is appended to captured_states, if given.
     """
     print(f"  [Playwright] Searching for '{search_query}'...")
     results = []
     
-    async with async_playwright() as p:
-        # Launch options
-        launch_args = {"headless": True}
-        if proxy_config:
-            launch_args["proxy"] = proxy_config
-            
-        browser = await p.chromium.launch(**launch_args)
-        
-        # Context options usually help avoid detection
-        context = await browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            viewport={"width": 1920, "height": 1080}
-        )
+    # Context options usually help avoid detection
+    context = await browser.new_context(
+        user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        viewport={"width": 1920, "height": 1080},
+        storage_state=storage_state
+    )
+    
+    page = await context.new_page()
+    
+    try:
+        # Navigate
+        url = f"https://www.carousell.sg/search/{search_query}"
+        # Block heavy resources to speed up
+        await page.route("**/*", block_heavy_resources)
         
-        page = await context.new_page()
+        # Ads/analytics beacons keep networkidle from firing; the card selector is the real signal
+        await page.goto(url, wait_until="domcontentloaded", timeout=30000)
         
+        # Smart wait for content
         try:
-            # Navigate
-            url = f"https://www.carousell.sg/search/{search_query}"
-            # Block heavy resources to speed up
-            await page.route("**/*.{png,jpg,jpeg,gif,webp}", lambda route: route.abort())
-            
-            await page.goto(url, wait_until="networkidle", timeout=60000)
+            await page.wait_for_selector('[data-testid="listing-card"]', timeout=15000)
+        except:
+            print("  [Playwright] Timeout waiting for listing cards. Checking for empty state or blocking.")
+            # Snapshot for debug in a real scenario, but here just return empty or raise
+            content = await page.content()
+            if "No results found" in content:
+                print("  [Playwright] No results found.")
+                return []
+            # If we are here, might be blocked or structure changed
+            raise Exception("Selector timeout - possible change in structure or blocking")
+
+        # Extract every card in one evaluate call instead of a CDP round-trip per field
+        cards = await page.evaluate(EXTRACT_CARDS_JS, max_results)
+        print(f"  [Playwright] Parsed {len(cards)} cards (max {max_results}).")
+        
+        for card in cards:
+            if not (card['title'] and card['price'] and card['href']):
+                continue
             
-            # Smart wait for content
+            results.append({
+                "title": card['title'],
+                "price_sgd": parse_price(card['price']),
+                "seller": card['seller'] or "Unknown",
+                "url": f"https://www.carousell.sg{card['href']}",
+                "source": "carousell",
+                "timestamp": datetime.utcnow().isoformat(),
+                "method": "playwright"
+            })
+        
+    except Exception as e:
+        print(f"  [Playwright] Error: {e}")
+        raise e
+    finally:
+        # Capturing state is best-effort and must not cost the scraped results
+        if captured_states is not None and results:
             try:
-                await page.wait_for_selector('[data-testid="listing-card"]', timeout=15000)
-            except:
-                print("  [Playwright] Timeout waiting for listing cards. Checking for empty state or blocking.")
-                # Snapshot for debug in a real scenario, but here just return empty or raise
-                content = await page.content()
-                if "No results found" in content:
-                    print("  [Playwright] No results found.")
-                    await browser.close()
-                    return []
-                # If we are here, might be blocked or structure changed
-                raise Exception("Selector timeout - possible change in structure or blocking")
-
-            # Extract
-            cards = await page.query_selector_all('[data-testid="listing-card"]')
-            print(f"  [Playwright] Found {len(cards)} cards (parsing max {max_results}).")
-            
-            for card in cards[:max_results]:
-                try:
-                    # Carousell structure heavily uses data-testid
-                    title_el = await card.query_selector('p[data-testid="listing-card-text-title"]')
-                    price_el = await card.query_selector('p[data-testid="listing-card-text-price"]')
-                    link_el = await card.query_selector('a')
-                    seller_el = await card.query_selector('p[data-testid="listing-card-text-seller-name"]')
-                    
-                    if not (title_el and price_el and link_el):
-                        continue
-                        
-                    title = await title_el.inner_text()
-                    price_text = await price_el.inner_text()
-                    href = await link_el.get_attribute('href')
-                    seller = await seller_el.inner_text() if seller_el else "Unknown"
-                    
-                    # Clean Price
-                    # "S$1,234" -> 1234.0
-                    price_clean = price_text.replace('S$', '').replace(',', '').strip()
-                    try:
-                        price_sgd = float(price_clean)
-                    except ValueError:
-                        price_sgd = 0.0
-                        
-                    full_url = f"https://www.carousell.sg{href}"
-                    
-                    results.append({
-                        "title": title,
-                        "price_sgd": price_sgd,
-                        "seller": seller,
-                        "url": full_url,
-                        "source": "carousell",
-                        "timestamp": datetime.utcnow().isoformat(),
-                        "method": "playwright"
-                    })
-                except Exception as e:
-                    continue # Skip bad card
-                    
-        except Exception as e:
-            print(f"  [Playwright] Error: {e}")
-            raise e # Re-raise to trigger backup
+                captured_states.append(await context.storage_state())
+            except Exception as e:
+                print(f"  [Playwright] Could not capture storage state: {e}")
+        await context.close()
+        
+    return results
+
+def load_storage_state(path):
+    """
+    Reads a saved Playwright storage state, or None if missing or unreadable.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except Exception as e:
+        print(f"  [Playwright] Ignoring unreadable storage state {path}: {e}")
+        return None
+
+def save_storage_state(path, state):
+    """
+    Writes the storage state via a temp file and os.replace so it is never torn.
+    """
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(state))
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"  [Playwright] Could not save storage state: {e}")
+
+async def scrape_playwright_all(queries, proxy_config=None, storage_state=None):
+    """
+    Runs the Playwright scraper for several queries concurrently on one browser.
+    If CDP_URL is set, attaches to that long-lived browser instead of launching
+    one (its proxy must then be configured where it was started).
+    If storage_state is a path, every context starts from the cookies saved
+    there and the state from a successful query is saved back once at the end.
+    """
+    initial_state = load_storage_state(storage_state)
+    captured_states = [] if storage_state else None
+    
+    async with async_playwright() as p:
+        cdp_url = os.getenv('CDP_URL')
+        if cdp_url:
+            print(f"  [Playwright] Connecting to browser at {cdp_url}")
+            browser = await p.chromium.connect_over_cdp(cdp_url)
+        else:
+            # Launch options
+            launch_args = {"headless": True}
+            if proxy_config:
+                launch_args["proxy"] = proxy_config
+                
+            browser = await p.chromium.launch(**launch_args)
+        
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+        
+        async def scrape_one(query):
+            async with semaphore:
+                return await scrape_playwright(
+                    browser, query, storage_state=initial_state, captured_states=captured_states
+                )
+        
+        try:
+            outcomes = await asyncio.gather(*(scrape_one(q) for q in queries), return_exceptions=True)
         finally:
+            # For a CDP connection this only disconnects; the browser keeps running
             await browser.close()
-            
+    
+    if captured_states:
+        save_storage_state(storage_state, captured_states[-1])
+    
+    results = []
+    for query, outcome in zip(queries, outcomes):
+        if isinstance(outcome, BaseException):
+            print(f"❌ Playwright fallback also failed for '{query}'.")
+        else:
+            results.extend(outcome)
+    
     return results
 
-def scrape_curl_cffi(search_query, proxy_url=None, max_results=50):
+SEARCH_API_URL = "https://www.carousell.sg/api-service/filter/search/2.2/"
+
+def scrape_api(search_query, proxy_url=None, max_results=50):
     """
-    Backup scraper using curl_cffi to impersonate real browser TLS.
-    Note: Carousell is an SPA (Single Page App). 
-    This method attempts to get initial data from extracting JSON from script tags 
-    or just pure HTML parsing if SSR is active.
+    Primary scraper: calls Carousell's internal search API directly, using
+    curl_cffi to impersonate real browser TLS. No browser is launched.
+    Returns None if the API could not be used, so the caller can fall back.
     """
     if not CURL_CFFI_AVAILABLE:
-        print("  [curl-cffi] Library not installed. Skipping backup.")
-        return []
+        print("  [API] curl-cffi not installed. Skipping.")
+        return None
         
-    print(f"  [curl-cffi] Backup search for '{search_query}'...")
+    print(f"  [API] Searching for '{search_query}'...")
     
-    url = f"https://www.carousell.sg/search/{search_query}"
     proxies = {"https": proxy_url, "http": proxy_url} if proxy_url else None
+    headers = {
+        "Referer": f"https://www.carousell.sg/search/{search_query}",
+        "Origin": "https://www.carousell.sg",
+        "Accept": "application/json",
+        "Accept-Language": "en-US,en;q=0.9",
+    }
     
     try:
-        # Impersonate Chrome 120 (newer) and add headers
-        response = crequests.get(
-            url,
-            impersonate="chrome120",
-            proxies=proxies,
-            headers={
-                "Referer": "https://www.google.com/",
-                "Accept-Language": "en-US,en;q=0.9",
-            },
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            print(f"  [curl-cffi] Status {response.status_code}")
-            return []
+        with crequests.Session() as session:
+            # Warm up on the search page so the API call carries the site's cookies
+            session.get(headers["Referer"], impersonate="chrome120", proxies=proxies, timeout=30)
             
-        # Basic HTML parsing - Looking for JSON embedded in Next.js/React hydration
-        # This is brittle but common for SPAs
-        # Strategy: Look for specific class names if simple parsing, 
-        # but regexing the window.initialState is better.
-        # For this MVP backup, we will try a simpler text search or basic bs4 if we had it.
-        # Since we don't have bs4 in requirements, we'll do raw string parsing or standard lib html.parser.
+            response = session.post(
+                SEARCH_API_URL,
+                impersonate="chrome120",
+                proxies=proxies,
+                headers=headers,
+                json={"count": max_results, "query": search_query, "countryCode": "SG"},
+                timeout=30
+            )
         
-        # Quick and dirty check if we got blocked
-        if "Access Denied" in response.text or "Cloudflare" in response.text:
-            print("  [curl-cffi] Blocked by WAF.")
-            return []
-
-        # NOTE: Parsing client-side rendered carousell with just requests is hard.
-        # This is a placeholder for a robust API-based approach.
-        print("  [curl-cffi] Page retrieved. (Parsing logic to be implemented for specific DOM structure)")
+        if response.status_code != 200:
+            print(f"  [API] Status {response.status_code}")
+            return None
         
-        # Logic: If we really needed this, we'd reverse the internal API:
-        # https://www.carousell.sg/api-service/filter/search/2.2/
-        # But that requires signing/tokens.
-        # Returning empty for now to signify "tried but unimplemented backup parsing"
-        # In a real deployed version, we would implement the API call here.
-        return []
-
+        listings = (orjson.loads(response.content).get("data") or {}).get("results")
+        if not isinstance(listings, list):
+            print("  [API] Unexpected response shape (blocked or API changed).")
+            return None
     except Exception as e:
-        print(f"  [curl-cffi] Error: {e}")
-        return []
+        print(f"  [API] Error: {e}")
+        return None
+    
+    results = []
+    for listing in listings[:max_results]:
+        try:
+            title = listing["title"]
+            href = listing["listingUrl"]
+            seller = (listing.get("seller") or {}).get("username") or "Unknown"
+            
+            try:
+                price_sgd = parse_price(str(listing["price"]["value"]))
+            except (KeyError, TypeError):
+                price_sgd = 0.0
+            
+            full_url = href if href.startswith("http") else f"https://www.carousell.sg{href}"
+            
+            results.append({
+                "title": title,
+                "price_sgd": price_sgd,
+                "seller": seller,
+                "url": full_url,
+                "source": "carousell",
+                "timestamp": datetime.utcnow().isoformat(),
+                "method": "api"
+            })
+        except (KeyError, TypeError, AttributeError):
+            continue # Skip malformed listing
+    
+    print(f"  [API] Parsed {len(results)} listings.")
+    return results
 
 async def main_async():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', required=True, help='Path to targets.yaml')
-    parser.add_argument('--output', required=True, help='Output JSON file')
+    parser.add_argument('--output', required=True, help='Output NDJSON file')
+    parser.add_argument('--storage-state', help='Persist Playwright cookies/storage here between runs')
     args = parser.parse_args()
     
     # Load config
@@ -215,26 +325,33 @@ async def main_async():
     
     all_results = []
     
-    for query in config['carousell']['queries']:
-        try:
-            # Try Primary
-            results = await scrape_playwright(query, proxy_config)
+    queries = config['carousell']['queries']
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+    
+    async def scrape_one(query):
+        async with semaphore:
+            return await asyncio.to_thread(scrape_api, query, proxy_url)
+    
+    # Try the API first; a browser is only needed for queries where it fails
+    failed = []
+    for query, results in zip(queries, await asyncio.gather(*(scrape_one(q) for q in queries), return_exceptions=True)):
+        if results is None or isinstance(results, BaseException):
+            print(f"⚠️ API scraper failed for '{query}'. Falling back to Playwright...")
+            failed.append(query)
+        else:
             all_results.extend(results)
-            # raise Exception("Force backup for testing")
+    
+    if failed:
+        try:
+            all_results.extend(await scrape_playwright_all(failed, proxy_config, args.storage_state))
         except Exception as e:
-            print(f"⚠️ Primary scraper failed for '{query}'. Attempting backup...")
-            # Try Backup (run sync in executor if needed, or just call direct)
-            # using the raw proxy string for requests
-            backup_results = scrape_curl_cffi(query, proxy_url)
-            if backup_results:
-                all_results.extend(backup_results)
-            else:
-                print(f"❌ Backup also failed (or unimplemented) for '{query}'.")
-
-    # Save
+            print(f"❌ Playwright fallback could not start: {e}")
+
+    # Save as NDJSON so analytics can stream snapshots line by line
     os.makedirs(os.path.dirname(args.output), exist_ok=True)
-    with open(args.output, 'w') as f:
-        json.dump(all_results, f, indent=2)
+    with open(args.output, 'wb') as f:
+        for item in all_results:
+            f.write(orjson.dumps(item) + b'\n')
     
     print(f"✅ Scraped {len(all_results)} listings -> {args.output}")
 